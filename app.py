@@ -2,136 +2,760 @@ import time
 import json
 import os
 import threading
+import queue
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import cv2
+import numpy as np
 from werkzeug.utils import secure_filename
 from flask import Flask, Response, render_template, request, redirect, url_for
 
+# Point at a libturbojpeg built with NASM if the system one lacks SIMD
+TURBOJPEG_LIB = os.getenv('TURBOJPEG_LIB')
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+    _tj = TurboJPEG(TURBOJPEG_LIB)
+    print(f"Using TurboJPEG from {TURBOJPEG_LIB or 'the default library path'}")
+except (ImportError, OSError, RuntimeError) as e:
+    print(f"TurboJPEG unavailable, falling back to cv2.imencode: {e}")
+    _tj = None
+
+# libjpeg-turbo picks the best SIMD kernels (AVX2 FDCT and Huffman) at runtime unless told not to
+for _var in ('JSIMD_FORCENONE', 'JSIMD_NOHUFFENC'):
+    if os.getenv(_var) == '1':
+        print(f"Warning: {_var}=1 disables libjpeg-turbo SIMD code, JPEG encoding will be slower")
+
+try:
+    import av
+except ImportError:
+    av = None
+
+# GPU JPEG encode through pynvjpeg, only picked up when a CUDA device is usable
+try:
+    from nvjpeg import NvJpeg
+    _nvjpeg = NvJpeg()
+except (ImportError, OSError, RuntimeError):
+    _nvjpeg = None
+
+def _cuda_decode_available():
+    try:
+        return hasattr(cv2, 'cudacodec') and cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+# Decode and scale on the GPU too when OpenCV is built with CUDA and nvJPEG does the encode
+CUDA_DECODE = _nvjpeg is not None and _cuda_decode_available()
+
 app = Flask(__name__)
 
 STREAMS_DIR = './streams'
 UPLOAD_PASSWORD = os.getenv('UPLOAD_PASSWORD')
 
+MJPEG_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n'
+MJPEG_TRAILER = b'\r\n'
+QUEUE_POLL_INTERVAL = 0.5
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+# A viewer that gets no frame for this long is let go so it doesn't hold a server thread
+FRAME_WAIT_TIMEOUT = 10
+
+# Frames are scaled down to fit this box before encoding; smaller sources are left alone
+MAX_STREAM_WIDTH = int(os.getenv('MAX_STREAM_WIDTH', '640'))
+MAX_STREAM_HEIGHT = int(os.getenv('MAX_STREAM_HEIGHT', '480'))
+# Decode through OpenCV with NVDEC/VAAPI/QSV when available, even if PyAV is installed
+HW_DECODE = os.getenv('HW_DECODE', '').lower() in ('1', 'true', 'yes')
+FFMPEG = shutil.which('ffmpeg')
+# Same sizing as target_size(), with both sides rounded to an even number
+PRERENDER_SCALE = (f"scale='min({MAX_STREAM_WIDTH},iw)':'min({MAX_STREAM_HEIGHT},ih)'"
+                   ":force_original_aspect_ratio=decrease:force_divisible_by=2")
+# Optional frame rate cap for pre-rendered frames, e.g. 15 for lighter streams
+PRERENDER_MAX_FPS = float(os.getenv('PRERENDER_MAX_FPS', '0'))
+# Frames buffered between the decode thread and the pacing loop of a frame_stream
+PIPELINE_DEPTH = 2
+# Encoder threads shared by every stream, one per core by default; the nvJPEG handle isn't safe to share
+ENCODE_WORKERS = 1 if _nvjpeg is not None else int(os.getenv('ENCODE_WORKERS', str(os.cpu_count() or 2)))
+_encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix='encode')
+
+# Defaults when metadata.json has no "jpeg_quality"; fast sources get cheaper frames
+JPEG_QUALITY = 75
+HIGH_FPS = 30
+HIGH_FPS_JPEG_QUALITY = 60
+CV2_JPEG_PARAMS = [
+    int(cv2.IMWRITE_JPEG_OPTIMIZE), 0,
+    int(cv2.IMWRITE_JPEG_PROGRESSIVE), 0,
+]
+if hasattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR'):
+    # Older OpenCV builds can't pick the subsampling
+    CV2_JPEG_PARAMS += [int(cv2.IMWRITE_JPEG_SAMPLING_FACTOR), int(cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420)]
+
+class StreamPaths:
+    # Built once per stream name so hot paths only join a filename onto a cached directory
+    __slots__ = ('root', 'metadata', 'videos', 'history', 'frames', 'offline')
+
+    def __init__(self, stream_name):
+        self.root = os.path.join(STREAMS_DIR, stream_name)
+        self.metadata = os.path.join(self.root, 'metadata.json')
+        self.videos = os.path.join(self.root, 'videos')
+        self.history = os.path.join(self.root, 'history')
+        self.frames = os.path.join(self.root, 'frames')
+        self.offline = os.path.join(self.root, 'offline.mp4')
+
+@lru_cache(maxsize=256)
+def get_stream_paths(stream_name):
+    return StreamPaths(stream_name)
+
+# mtimes are only as fine as the filesystem's clock tick (1 s on some), so anything read
+# within this long of the last change may miss a second change in that tick
+RACY_MTIME_NS = 1_000_000_000
+
+# Keyed on mtime and size; load_metadata bypasses it while the mtime is still racy
+@lru_cache(maxsize=128)
+def _read_metadata(metadata_path, mtime_ns, size):
+    with open(metadata_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
 def load_metadata(stream_name):
-    metadata_path = os.path.join(STREAMS_DIR, stream_name, 'metadata.json')
+    metadata_path = get_stream_paths(stream_name).metadata
     try:
-        with open(metadata_path, 'r', encoding='utf-8') as file:
-            return json.load(file)
+        st = os.stat(metadata_path)
+        if time.time_ns() - st.st_mtime_ns <= RACY_MTIME_NS:
+            # A same-size rewrite later in this tick would keep the key, so don't cache yet
+            return _read_metadata.__wrapped__(metadata_path, st.st_mtime_ns, st.st_size)
+        return _read_metadata(metadata_path, st.st_mtime_ns, st.st_size)
     except (FileNotFoundError, json.JSONDecodeError) as e:
         print(f"Error loading metadata for {stream_name}: {e}")
         return None
 
+_streams_cache = None
+
+def get_streams():
+    global _streams_cache
+    # Adding or removing a stream directory bumps the streams directory mtime
+    mtime = os.stat(STREAMS_DIR).st_mtime_ns
+    cacheable = time.time_ns() - mtime > RACY_MTIME_NS
+    if _streams_cache is not None and _streams_cache[0] == mtime:
+        return _streams_cache[1]
+
+    # DirEntry.is_dir() uses the type readdir already returned instead of a stat per entry
+    with os.scandir(STREAMS_DIR) as entries:
+        streams = sorted(entry.name for entry in entries if entry.is_dir())
+    _streams_cache = (mtime, streams) if cacheable else None
+    return streams
+
+_queue_cache = {}
+_archive_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archive')
+_archiving = set()
+_archiving_lock = threading.Lock()
+
 def get_video_queue(stream_name):
-    video_dir = os.path.join(STREAMS_DIR, stream_name, 'videos')
-    history_dir = os.path.join(STREAMS_DIR, stream_name, 'history')
-    
+    paths = get_stream_paths(stream_name)
+    video_dir, history_dir = paths.videos, paths.history
+
     try:
-        videos = sorted([f for f in os.listdir(video_dir) if f.endswith('.mp4')])
-        history = set(os.listdir(history_dir))
+        # Directory mtimes only change when entries are added, removed or renamed
+        mtimes = (os.stat(video_dir).st_mtime_ns, os.stat(history_dir).st_mtime_ns)
+        cacheable = time.time_ns() - max(mtimes) > RACY_MTIME_NS
+        cached = _queue_cache.get(stream_name)
+        if cached is not None and cached[0] == mtimes:
+            return _without_archiving(stream_name, cached[1])
+
+        with os.scandir(video_dir) as entries:
+            videos = sorted(entry.name for entry in entries if entry.name.endswith('.mp4'))
+        with os.scandir(history_dir) as entries:
+            history = {entry.name for entry in entries}
     except FileNotFoundError as e:
         print(f"Error accessing video or history directories for {stream_name}: {e}")
         return []
-    
-    return [v for v in videos if v not in history]
 
-def resize_frame_with_aspect_ratio(frame, target_width=640, target_height=480):
-    h, w = frame.shape[:2]
-    aspect_ratio = w / h
-
-    if w > h:
-        new_w = target_width
-        new_h = int(target_width / aspect_ratio)
+    video_queue = [v for v in videos if v not in history]
+    if cacheable:
+        _queue_cache[stream_name] = (mtimes, video_queue)
     else:
-        new_h = target_height
-        new_w = int(target_height * aspect_ratio)
+        _queue_cache.pop(stream_name, None)
+    return _without_archiving(stream_name, video_queue)
 
-    return cv2.resize(frame, (new_w, new_h))
+def _without_archiving(stream_name, video_queue):
+    # Videos handed to the archive worker are finished even if the move hasn't happened yet
+    with _archiving_lock:
+        if not _archiving:
+            return list(video_queue)
+        return [v for v in video_queue if (stream_name, v) not in _archiving]
 
-def frame_stream(video_path, stop_event):
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        print(f"Error: Could not open video file {video_path}")
+def _archive_video(stream_name, video_filename, video_path, history_path):
+    try:
+        os.replace(video_path, history_path)
+        print(f"Moved to history: {history_path}")
+    except Exception as e:
+        print(f"Error moving file to history: {e}")
+    finally:
+        shutil.rmtree(get_frames_dir(stream_name, video_filename), ignore_errors=True)
+        _queue_cache.pop(stream_name, None)
+        with _archiving_lock:
+            _archiving.discard((stream_name, video_filename))
+
+def archive_video(stream_name, video_filename):
+    paths = get_stream_paths(stream_name)
+    video_path = os.path.join(paths.videos, video_filename)
+    history_path = os.path.join(paths.history, video_filename)
+    with _archiving_lock:
+        _archiving.add((stream_name, video_filename))
+    _archive_pool.submit(_archive_video, stream_name, video_filename, video_path, history_path)
+
+# ffmpeg already spreads a single render over every core, so uploads take turns
+_prerender_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prerender')
+
+def get_frames_dir(stream_name, video_filename):
+    return os.path.join(get_stream_paths(stream_name).frames, video_filename)
+
+def _prerender_video(stream_name, video_filename):
+    video_path = os.path.join(get_stream_paths(stream_name).videos, video_filename)
+    frames_dir = get_frames_dir(stream_name, video_filename)
+    # Extract into a scratch directory so playback never sees a partial sequence
+    tmp_dir = frames_dir + '.tmp'
+
+    try:
+        cap = cv2.VideoCapture(video_path)
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        cap.release()
+
+        if fps <= 0:
+            fps = PRERENDER_MAX_FPS if PRERENDER_MAX_FPS > 0 else 30.0
+        elif PRERENDER_MAX_FPS > 0 and fps > PRERENDER_MAX_FPS:
+            fps = PRERENDER_MAX_FPS
+        # image2 picks its own constant rate for variable frame rate input, so pin it to the one recorded
+        video_filter = f"fps={fps},{PRERENDER_SCALE}"
+
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        result = subprocess.run([FFMPEG, '-nostdin', '-loglevel', 'error', '-i', video_path,
+                                 '-vf', video_filter, '-q:v', '4', os.path.join(tmp_dir, '%06d.jpg')],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"Error pre-rendering {video_path}: {result.stderr.strip()}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        with open(os.path.join(tmp_dir, 'fps.txt'), 'w', encoding='utf-8') as file:
+            file.write(str(fps))
+        shutil.rmtree(frames_dir, ignore_errors=True)
+
+        # The archiver deletes the frames after moving the video, so they can only be
+        # published while it hasn't picked the video up yet
+        with _archiving_lock:
+            queued = (stream_name, video_filename) not in _archiving and os.path.exists(video_path)
+            if queued:
+                os.replace(tmp_dir, frames_dir)
+        if not queued:
+            # Already played and archived while ffmpeg was running
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        print(f"Pre-rendered {video_path} to {frames_dir}")
+    except Exception as e:
+        print(f"Error pre-rendering {video_path}: {e}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def prerender_video(stream_name, video_filename):
+    # Pays for decode/scale/encode once at upload instead of on every playback
+    if FFMPEG is None:
         return
+    _prerender_pool.submit(_prerender_video, stream_name, video_filename)
 
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    frame_interval = 1.0 / fps if fps > 0 else 1.0 / 30
+def target_size(w, h, target_width=MAX_STREAM_WIDTH, target_height=MAX_STREAM_HEIGHT):
+    # Fit inside the box keeping the aspect ratio; upscaling would only add pixels to encode and send
+    scale = min(target_width / w, target_height / h, 1)
+    return max(1, int(w * scale)), max(1, int(h * scale))
+
+def get_jpeg_quality(stream_name):
+    metadata = load_metadata(stream_name)
+    quality = metadata.get("jpeg_quality") if metadata else None
+    if quality is None:
+        return None
+    # bool is an int subclass, so JSON true would otherwise pass as quality 1
+    if isinstance(quality, bool) or not isinstance(quality, int) or not 1 <= quality <= 100:
+        print(f"Ignoring invalid jpeg_quality for {stream_name}: {quality!r}")
+        return None
+    return quality
+
+# Worst-case sized TurboJPEG output buffer, reused by each encoding thread
+_scratch = threading.local()
+
+def _encode_bgr_turbojpeg(frame, quality):
+    if not hasattr(_tj, 'buffer_size'):
+        # PyTurboJPEG before 1.8.2 can't encode into a caller's buffer
+        return _tj.encode(frame, quality=quality, pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420)
+
+    needed = _tj.buffer_size(frame, TJSAMP_420)
+    buf = getattr(_scratch, 'buf', None)
+    if buf is None or len(buf) < needed:
+        buf = _scratch.buf = bytearray(needed)
+
+    _, length = _tj.encode(frame, quality=quality, pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420, dst=buf)
+    return bytes(memoryview(buf)[:length])
+
+def encode_jpeg(frame, quality=JPEG_QUALITY):
+    if _nvjpeg is not None:
+        return _nvjpeg.encode(frame, quality)
+
+    # libjpeg-turbo encodes straight from the BGR buffer and hands back bytes
+    if _tj is not None:
+        if frame.ndim == 2:
+            # Planar YUV 4:2:0 from PyAV, no colour conversion needed
+            height, width = frame.shape[0] * 2 // 3, frame.shape[1]
+            return _tj.encode_from_yuv(frame, height, width, quality=quality, jpeg_subsample=TJSAMP_420)
+        return _encode_bgr_turbojpeg(frame, quality)
+
+    success, jpeg = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality] + CV2_JPEG_PARAMS)
+    return jpeg.tobytes() if success else None
+
+class FrameDropper:
+    # Frames the pacing loop has fallen behind by, for the decoder to skip
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def add(self, count):
+        with self.lock:
+            self.pending += count
+
+    def take(self):
+        with self.lock:
+            count, self.pending = self.pending, 0
+        return count
+
+def _open_cv2(video_path, loop, dropper):
+    if hasattr(cv2, 'CAP_PROP_HW_ACCELERATION'):
+        # Falls back to software decode by itself when there is no usable device
+        cap = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG,
+                               [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY])
+    else:
+        cap = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG)
+    if not cap.isOpened():
+        cap.release()
+        return None
+
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    size = target_size(width, height) if width > 0 and height > 0 else None
+    if size is not None:
+        # Backends that honour this scale while decoding, and the resize below is skipped
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, size[0])
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, size[1])
+
+    def frames():
+        nonlocal size
+        # One buffer per frame that can be in flight: queued, being encoded, being decoded
+        buffers = []
+        try:
+            decoded = False
+            while cap.isOpened():
+                # grab() still decodes but skips retrieving and converting the frame
+                for _ in range(dropper.take()):
+                    if not cap.grab():
+                        break
+
+                ret, frame = cap.read()
+                if not ret:
+                    if not (loop and decoded):
+                        return
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    decoded = False
+                    continue
+
+                decoded = True
+                if size is None:
+                    size = target_size(frame.shape[1], frame.shape[0])
+                if (frame.shape[1], frame.shape[0]) == size:
+                    yield frame
+                    continue
+
+                # Resize into a small ring of reused buffers
+                if len(buffers) < PIPELINE_DEPTH + 2:
+                    dst = np.empty((size[1], size[0], 3), dtype=np.uint8)
+                else:
+                    dst = buffers.pop(0)
+                buffers.append(dst)
+                yield cv2.resize(frame, size, dst=dst, interpolation=cv2.INTER_AREA)
+        finally:
+            cap.release()
+
+    return cap.get(cv2.CAP_PROP_FPS), frames(), False
+
+def _open_av(video_path, loop, dropper):
+    try:
+        container = av.open(video_path)
+        stream = container.streams.video[0]
+    except (av.error.FFmpegError, IndexError) as e:
+        print(f"Error opening {video_path} with PyAV: {e}")
+        return None
+
+    fps = float(stream.average_rate or 0)
+    if stream.codec_context.name == 'mjpeg':
+        # Every packet is already a complete JPEG, so pass them through untouched
+        return fps, _demux_jpeg(container, stream, loop, dropper), True
+
+    stream.thread_type = 'AUTO'
+    new_w, new_h = target_size(stream.codec_context.width, stream.codec_context.height)
+    # 4:2:0 chroma needs even dimensions
+    new_w, new_h = new_w & ~1, new_h & ~1
+    # TurboJPEG encodes the planes as-is, but reads their rows padded to 4 bytes while
+    # to_ndarray() packs them, so that only lines up when the chroma width is a multiple of 4
+    use_yuv = _tj is not None and _nvjpeg is None and new_w % 8 == 0
+    pixel_format = 'yuvj420p' if use_yuv else 'bgr24'
+
+    def frames():
+        skip = 0
+        try:
+            while True:
+                decoded = False
+                for frame in container.decode(stream):
+                    decoded = True
+                    # Dropped frames still have to be decoded, but are never scaled or converted
+                    skip += dropper.take()
+                    if skip:
+                        skip -= 1
+                        continue
+
+                    frame = frame.reformat(width=new_w, height=new_h, format=pixel_format, interpolation='AREA')
+                    yield frame.to_ndarray()
+                if not (loop and decoded):
+                    return
+                container.seek(0)
+        finally:
+            container.close()
+
+    return fps, frames(), False
+
+def _demux_jpeg(container, stream, loop, dropper):
+    skip = 0
+    try:
+        while True:
+            demuxed = False
+            for packet in container.demux(stream):
+                if packet.size == 0:
+                    continue  # Flush packet at end of stream
+
+                demuxed = True
+                skip += dropper.take()
+                if skip:
+                    skip -= 1
+                    continue
+
+                yield bytes(packet)
+            if not (loop and demuxed):
+                return
+            container.seek(0)
+    finally:
+        container.close()
+
+def _open_prerendered(frames_dir, loop, dropper):
+    try:
+        with open(os.path.join(frames_dir, 'fps.txt'), 'r', encoding='utf-8') as file:
+            fps = float(file.read())
+        with os.scandir(frames_dir) as entries:
+            paths = sorted(entry.path for entry in entries if entry.name.endswith('.jpg'))
+    except (FileNotFoundError, ValueError):
+        return None
+    if not paths:
+        return None
 
-    while cap.isOpened() and not stop_event.is_set():
-        ret, frame = cap.read()
-        if not ret:
-            print(f"Reached end of video: {video_path}")
-            break
+    def frames():
+        skip = 0
+        while True:
+            for path in paths:
+                skip += dropper.take()
+                if skip:
+                    skip -= 1
+                    continue
+
+                with open(path, 'rb') as file:
+                    yield file.read()
+            if not loop:
+                return
+
+    return fps, frames(), True
+
+def _open_cuda(video_path, loop, dropper):
+    try:
+        reader = cv2.cudacodec.createVideoReader(video_path)
+    except cv2.error as e:
+        print(f"Error opening {video_path} with cudacodec: {e}")
+        return None
 
-        frame = resize_frame_with_aspect_ratio(frame)
+    def frames():
+        nonlocal reader
+        size = None
+        decoded = False
+        while True:
+            for _ in range(dropper.take()):
+                if not reader.grab():
+                    break
+
+            ret, gpu_frame = reader.nextFrame()
+            if not ret:
+                if not (loop and decoded):
+                    return
+                reader = cv2.cudacodec.createVideoReader(video_path)
+                decoded = False
+                continue
 
-        success, jpeg = cv2.imencode('.jpg', frame)
-        if not success:
+            decoded = True
+            if size is None:
+                size = target_size(*gpu_frame.size())
+            if gpu_frame.size() != size:
+                gpu_frame = cv2.cuda.resize(gpu_frame, size, interpolation=cv2.INTER_AREA)
+            if gpu_frame.channels() == 4:
+                gpu_frame = cv2.cuda.cvtColor(gpu_frame, cv2.COLOR_BGRA2BGR)
+            # Only the scaled frame crosses PCIe, on its way to nvJPEG
+            yield gpu_frame.download()
+
+    return getattr(reader.format(), 'fps', 0), frames(), False
+
+def is_rotated(video_path):
+    # Phone videos are often stored sideways with a display matrix. OpenCV's FFmpeg
+    # backend applies it while decoding, but PyAV and cudacodec hand back the raw frames
+    if not hasattr(cv2, 'CAP_PROP_ORIENTATION_META'):
+        return False
+    cap = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG)
+    try:
+        return int(cap.get(cv2.CAP_PROP_ORIENTATION_META)) % 360 != 0
+    finally:
+        cap.release()
+
+# Returns (fps, frames, encoded), or None if the video can't be opened. Frames are
+# JPEG bytes when encoded is true, otherwise arrays already scaled for encode_jpeg.
+# PyAV decodes and scales in a single libavcodec/libswscale pass when installed;
+# rotated videos always go through OpenCV so they play upright.
+def open_video(video_path, loop=False, dropper=None):
+    if dropper is None:
+        dropper = FrameDropper()
+    if (CUDA_DECODE or (av is not None and not HW_DECODE)) and is_rotated(video_path):
+        return _open_cv2(video_path, loop, dropper)
+    if CUDA_DECODE:
+        return _open_cuda(video_path, loop, dropper)
+    if av is not None and not HW_DECODE:
+        return _open_av(video_path, loop, dropper)
+    return _open_cv2(video_path, loop, dropper)
+
+_END = object()
+
+def _put(out_q, item, halt):
+    while not halt.is_set():
+        try:
+            out_q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _drain(in_q, halt):
+    while not halt.is_set():
+        try:
+            item = in_q.get(timeout=0.5)
+        except queue.Empty:
             continue
+        if item is _END:
+            return
+        yield item
+
+def _run_stage(items, out_q, halt, work=None):
+    try:
+        for item in items:
+            if work is not None:
+                item = work(item)
+            if not _put(out_q, item, halt):
+                return
+    except Exception as e:
+        print(f"Error in frame pipeline: {e}")
+    finally:
+        items.close()
+        _put(out_q, _END, halt)
+
+def frame_stream(video_path, stop_event, loop=False, quality=None, frames_dir=None):
+    halt = threading.Event()
+    dropper = FrameDropper()
+    jpeg_q = queue.Queue(maxsize=PIPELINE_DEPTH)
+
+    video = _open_prerendered(frames_dir, loop, dropper) if frames_dir else None
+    if video is None:
+        video = open_video(video_path, loop, dropper)
+    if video is None:
+        print(f"Error: Could not open video file {video_path}")
+        return
+
+    fps, frames, encoded = video
+    if encoded:
+        # Already JPEG, so there is nothing to decode or encode
+        work = None
+    else:
+        if quality is None:
+            quality = HIGH_FPS_JPEG_QUALITY if fps > HIGH_FPS else JPEG_QUALITY
 
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n')
-        time.sleep(frame_interval)
+        # Frames are encoded on the shared pool while the next ones decode; the queue
+        # keeps their futures in order. cv2, PyAV and TurboJPEG all release the GIL
+        def work(frame):
+            return _encode_pool.submit(encode_jpeg, frame, quality)
 
-    cap.release()
+    frame_interval = 1.0 / fps if fps > 0 else 1.0 / 30
+    decoder = threading.Thread(target=_run_stage, args=(frames, jpeg_q, halt, work), daemon=True)
+    decoder.start()
+    # Opening the container and decoding the first keyframe isn't playback lag
+    deadline = None
 
-def generate_mjpeg_stream(stream_name):
-    stop_event = threading.Event()
-    while True:
+    try:
+        for jpeg_bytes in _drain(jpeg_q, halt):
+            if stop_event.is_set():
+                return
+
+            if not encoded:
+                try:
+                    jpeg_bytes = jpeg_bytes.result()
+                except Exception as e:
+                    print(f"Error encoding frame: {e}")
+                    continue
+                if jpeg_bytes is None:
+                    continue
+
+            if deadline is None:
+                deadline = time.monotonic()
+            yield jpeg_bytes
+
+            # Sleep until the next frame is due so decode/encode time isn't added on top
+            deadline += frame_interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Skip whole frames we're late for instead of falling further behind
+                frames_behind = int(-delay / frame_interval)
+                if frames_behind:
+                    dropper.add(frames_behind)
+                    deadline += frames_behind * frame_interval
+        print(f"Reached end of video: {video_path}")
+    finally:
+        halt.set()
+        decoder.join()
+
+def playlist_stream(stream_name, stop_event):
+    paths = get_stream_paths(stream_name)
+    while not stop_event.is_set():
         video_queue = get_video_queue(stream_name)
 
         if video_queue:
             video_filename = video_queue.pop(0)
-            video_path = os.path.join(STREAMS_DIR, stream_name, 'videos', video_filename)
-            history_path = os.path.join(STREAMS_DIR, stream_name, 'history', video_filename)
+            video_path = os.path.join(paths.videos, video_filename)
             print(f"Switching to video: {video_path}")
             try:
-                for frame in frame_stream(video_path, stop_event):
+                frames = frame_stream(video_path, stop_event, quality=get_jpeg_quality(stream_name),
+                                      frames_dir=get_frames_dir(stream_name, video_filename))
+                for frame in frames:
                     yield frame
             finally:
-                try:
-                    os.rename(video_path, history_path)
-                    print(f"Moved to history: {history_path}")
-                except Exception as e:
-                    print(f"Error moving file to history: {e}")
+                archive_video(stream_name, video_filename)
         else:
-            offline_path = os.path.join(STREAMS_DIR, stream_name, 'offline.mp4')
+            offline_path = paths.offline
             if not os.path.exists(offline_path):
                 print("Error: offline.mp4 not found!")
                 time.sleep(2)
                 continue
 
-            cap = cv2.VideoCapture(offline_path)
-            if not cap.isOpened():
-                print(f"Error: Could not open offline video {offline_path}")
-                time.sleep(2)
-                continue
-
-            fps = cap.get(cv2.CAP_PROP_FPS)
-            frame_interval = 1.0 / fps if fps > 0 else 1.0 / 30
-
-            while cap.isOpened():
-                if get_video_queue(stream_name):  # Check for new videos
-                    print("New video found, switching from offline.")
-                    break
-
-                ret, frame = cap.read()
-                if not ret:
-                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                    continue
+            opened = False
+            next_poll = 0.0
+            offline = frame_stream(offline_path, stop_event, loop=True, quality=get_jpeg_quality(stream_name))
+            try:
+                for frame in offline:
+                    opened = True
+                    now = time.monotonic()
+                    if now >= next_poll:  # Check for new videos
+                        next_poll = now + QUEUE_POLL_INTERVAL
+                        if get_video_queue(stream_name):
+                            print("New video found, switching from offline.")
+                            break
 
-                frame = resize_frame_with_aspect_ratio(frame)
+                    yield frame
+            finally:
+                offline.close()
 
-                success, jpeg = cv2.imencode('.jpg', frame)
-                if not success:
-                    continue
+            if not opened:
+                time.sleep(2)
 
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n')
-                time.sleep(frame_interval)
+_broadcasters = {}
+_broadcasters_lock = threading.Lock()
+
+class Broadcaster:
+    # Runs a single playlist_stream per stream and fans each frame out to every viewer
+    def __init__(self, stream_name, previous=None):
+        self.stream_name = stream_name
+        self.previous = previous
+        self.cond = threading.Condition()
+        self.latest = None
+        self.seq = 0
+        self.running = True
+        self.subscribers = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=f"broadcast-{stream_name}", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        if self.previous is not None:
+            # Let the last producer for this stream hand its video to the archiver first
+            self.previous.thread.join()
+            self.previous = None
+
+        try:
+            for jpeg_bytes in playlist_stream(self.stream_name, self.stop_event):
+                # The multipart part is assembled once here and shared by every viewer
+                frame = b''.join((MJPEG_HEADER % len(jpeg_bytes), jpeg_bytes, MJPEG_TRAILER))
+                with self.cond:
+                    self.latest = frame
+                    self.seq += 1
+                    self.cond.notify_all()
+        finally:
+            # Also covers a crashed producer, so the next viewer starts a fresh one
+            self.stop_event.set()
+            with self.cond:
+                self.running = False
+                self.cond.notify_all()
+
+    def frames(self):
+        seq = 0
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.seq != seq or not self.running, timeout=FRAME_WAIT_TIMEOUT)
+                if self.seq == seq:
+                    return
+                seq = self.seq
+                frame = self.latest
+            yield frame
+
+def subscribe(stream_name):
+    with _broadcasters_lock:
+        broadcaster = _broadcasters.get(stream_name)
+        if broadcaster is None or broadcaster.stop_event.is_set():
+            broadcaster = Broadcaster(stream_name, previous=broadcaster)
+            _broadcasters[stream_name] = broadcaster
+        broadcaster.subscribers += 1
+    return broadcaster
+
+def unsubscribe(broadcaster):
+    with _broadcasters_lock:
+        broadcaster.subscribers -= 1
+        if broadcaster.subscribers == 0:
+            print(f"No viewers left, stopping stream: {broadcaster.stream_name}")
+            broadcaster.stop_event.set()
 
-            cap.release()
+def generate_mjpeg_stream(stream_name):
+    broadcaster = subscribe(stream_name)
+    try:
+        yield from broadcaster.frames()
+    finally:
+        unsubscribe(broadcaster)
 
 @app.route('/<stream_name>/video_feed')
 def video_feed(stream_name):
+    if not os.path.isdir(get_stream_paths(stream_name).root):
+        return "Stream not found.", 404
     return Response(generate_mjpeg_stream(stream_name),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
@@ -146,16 +770,15 @@ def index():
     if not os.path.exists(STREAMS_DIR):
         os.makedirs(STREAMS_DIR)
 
-    streams = [d for d in os.listdir(STREAMS_DIR) if os.path.isdir(os.path.join(STREAMS_DIR, d))]
     stream_metadata = {}
-    for stream in streams:
+    for stream in get_streams():
         metadata = load_metadata(stream)
         stream_metadata[stream] = metadata["name"] if metadata and "name" in metadata else stream
     return render_template('index.html', stream_metadata=stream_metadata)
 
 @app.route('/<stream_name>/upload', methods=['GET', 'POST'])
 def upload(stream_name):
-    videos_dir = os.path.join(STREAMS_DIR, stream_name, 'videos')
+    videos_dir = get_stream_paths(stream_name).videos
     os.makedirs(videos_dir, exist_ok=True)
 
     # Get metadata and any stream-specific env var password names
@@ -186,7 +809,17 @@ def upload(stream_name):
         if file and file.filename.endswith('.mp4'):
             filename = secure_filename(file.filename)
             upload_path = os.path.join(videos_dir, filename)
-            file.save(upload_path)
+            # Large unbuffered writes, under a name the queue ignores until the copy is complete
+            partial_path = upload_path + '.part'
+            with open(partial_path, 'wb', buffering=0) as dst:
+                try:
+                    shutil.copyfileobj(file.stream, dst, UPLOAD_CHUNK_SIZE)
+                except Exception:
+                    # e.g. ENOSPC or a dropped client; don't leave the partial file behind
+                    os.remove(partial_path)
+                    raise
+            os.replace(partial_path, upload_path)
+            prerender_video(stream_name, filename)
             return redirect(url_for('stream_page', stream_name=stream_name))
         return "Invalid file format. Only .mp4 files are allowed.", 400
 
@@ -0,0 +1,17 @@
+# gunicorn -c gunicorn.conf.py app:app
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+
+# Broadcasters live inside the worker process, so a second worker would play every
+# stream's queue again and race the first one over moving videos to history
+workers = 1
+
+# Viewers spend nearly all their time waiting on the broadcaster's condition, so a
+# thread each is cheap, and decode/encode stay on real threads that release the GIL
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '128'))
+
+# Keep the worker heartbeat file off disk-backed /tmp, which can stall under load in containers
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'